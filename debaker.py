@@ -1,28 +1,120 @@
+from __future__ import annotations
+
+import codecs
 import os
+import re
 import struct
 import sys
+from collections.abc import Iterator
+
+_INT_BE = struct.Struct(">i")
+_LINESEP = os.linesep.encode("ascii")
+_DOTDOT_RE = re.compile(r"^(?:\.\.\\)+")
+# Matches either a whole "[section]" line or a "key=value" line
+_INI_LINE_RE = re.compile(r"^\[(.*)\]$|^([^=\n]*)=(.*)$", re.MULTILINE)
+
+# Decodes straight from a buffer slice without copying it into bytes first
+_decode_utf16 = codecs.utf_16_le_decode
+
+# Yields (full_path, bin_path_utf16, bin_path_len) in os.walk order,
+# where bin_path is the UE3 name stored in the .BIN (..\..\ prefix)
+def _iter_input_files(input_dir: str) -> Iterator[tuple[str, bytes, int]]:
+    stack: list[tuple[str, str]] = [(input_dir, "..\\..\\")]
+    while stack:
+        dir_path, bin_prefix = stack.pop()
+        subdirs: list[tuple[str, str]] = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, bin_prefix + entry.name + "\\"))
+                    continue
+                bin_path = (bin_prefix + entry.name).encode("utf-16le")
+                # Length in UTF-16 code units, like every other header
+                yield entry.path, bin_path, len(bin_path) // 2
+        stack.extend(reversed(subdirs))
+
+# Decodes sec_count sections starting at pos into ini file contents.
+# Lengths are read inline unless a tool is given; --debug runs pass one so
+# every field goes through its checked, logging readers.
+def _decode_sections(
+    buf: memoryview, pos: int, sec_count: int, tool: CoalescedTool | None = None
+) -> tuple[str, int]:
+    read_int = _INT_BE.unpack_from
+    parts: list[str] = []
+    for sec_index in range(sec_count):
+        if tool is None:
+            raw_len = read_int(buf, pos)[0]
+            pos += 4
+            sec_name_len = (-raw_len - 1) * 2 if raw_len < 0 else raw_len
+        else:
+            sec_name_len, pos = tool.read_name_length_be(buf, pos)
+        section_name = _decode_utf16(buf[pos:pos + sec_name_len], "strict", True)[0]
+        pos += sec_name_len + 2  # skip null terminator
+
+        parts.append(f"[{section_name}]\n")
+
+        if tool is None:
+            rec_count = read_int(buf, pos)[0]
+            pos += 4
+        else:
+            rec_count, pos = tool.read_int_be(buf, pos)
+
+        for _ in range(rec_count):
+            if tool is None:
+                raw_len = read_int(buf, pos)[0]
+                pos += 4
+                key_name_len = (-raw_len - 1) * 2 if raw_len < 0 else raw_len
+            else:
+                key_name_len, pos = tool.read_name_length_be(buf, pos)
+            key_name = _decode_utf16(buf[pos:pos + key_name_len], "strict", True)[0]
+            pos += key_name_len + 2  # skip null terminator
+
+            parts.append(f"{key_name}=")
+
+            if tool is None:
+                raw_len = read_int(buf, pos)[0]
+                pos += 4
+                value_len = -raw_len - 1 if raw_len < 0 else raw_len
+            else:
+                value_len, pos = tool.read_value_length_be(buf, pos)
+            if value_len > 0:
+                value_end = pos + value_len * 2
+                value = _decode_utf16(buf[pos:value_end], "strict", True)[0]
+                pos = value_end + 2  # skip null terminator
+                # Newlines become ¶ so each record stays on one line
+                value = value.replace("\n", "\u00B6").rstrip("\r\n")
+                parts.append(value)
+
+            parts.append("\n")
+
+        if sec_index != sec_count - 1:
+            parts.append("\n")
+
+    return "".join(parts), pos
+
+def _write_ini(path: str, text: str) -> None:
+    data = text.encode("utf-8")
+    if _LINESEP != b"\n":
+        # Match the newline translation text mode used to do
+        data = data.replace(b"\n", _LINESEP)
+    with open(path, "wb") as out_file:
+        out_file.write(data)
 
 class CoalescedTool:
-    def __init__(self, debug=False):
-        self.files = 0
-        self.nmlen = 0
-        self.secCount = 0
-        self.recCount = 0
-        self.valueLength = 0
-        self.fullpath = ""
+    def __init__(self, debug: bool = False) -> None:
         self.debug = debug
 
-    def read_int_be(self, f):
-        data = f.read(4)
-        if len(data) < 4:
+    def read_int_be(self, buf: bytes | memoryview, pos: int) -> tuple[int, int]:
+        if pos + 4 > len(buf):
             raise EOFError("Unexpected EOF while reading int")
-        val = struct.unpack(">i", data)[0]
+        val = _INT_BE.unpack_from(buf, pos)[0]
         if self.debug:
             print(f"[DEBUG] read_int_be: {val}")
-        return val
+        return val, pos + 4
 
-    def read_name_length_be(self, f):
-        raw_len = self.read_int_be(f)
+    def read_name_length_be(self, buf: bytes | memoryview, pos: int) -> tuple[int, int]:
+        raw_len, pos = self.read_int_be(buf, pos)
         if raw_len < 0:
             length_bytes = (-raw_len - 1) * 2
             style = "NEG"
@@ -31,10 +123,10 @@ class CoalescedTool:
             style = "POS"
         if self.debug:
             print(f"[DEBUG] Name length raw={raw_len} style={style} bytes={length_bytes}")
-        return length_bytes
+        return length_bytes, pos
 
-    def read_value_length_be(self, f):
-        raw_len = self.read_int_be(f)
+    def read_value_length_be(self, buf: bytes | memoryview, pos: int) -> tuple[int, int]:
+        raw_len, pos = self.read_int_be(buf, pos)
         if raw_len < 0:
             val_len = -raw_len - 1
             style = "NEG"
@@ -43,35 +135,31 @@ class CoalescedTool:
             style = "POS"
         if self.debug:
             print(f"[DEBUG] Value length raw={raw_len} style={style} chars={val_len}")
-        return val_len
+        return val_len, pos
 
-    def decode_name(self, name_bytes):
-        try:
-            return name_bytes.decode("utf-16le")
-        except UnicodeDecodeError:
-            try:
-                return name_bytes.decode("latin-1")
-            except UnicodeDecodeError:
-                return name_bytes.decode("utf-8", errors="replace")
-
-    def validate_coalesced(self, file_path):
+    def decode_name(self, name_bytes: bytes) -> str:
+        return name_bytes.decode("utf-16le", errors="replace")
+
+    def validate_coalesced(self, file_path: str) -> bool:
         try:
+            # Only the file count and first name are needed, not the whole file
             with open(file_path, "rb") as f:
-                self.files = self.read_int_be(f)
-                self.nmlen = self.read_name_length_be(f)
-                name_bytes = f.read(self.nmlen)
-                self.fullpath = self.decode_name(name_bytes)
-                if self.debug:
-                    print(f"[DEBUG] files={self.files}, fullpath={self.fullpath}")
-                if self.files == 0 or self.files > 10000:
-                    print("Probably not a Coalesced file.")
-                    return False
-                return True
+                header = f.read(8)
+                files, _ = self.read_int_be(header, 0)
+                nmlen, _ = self.read_name_length_be(header, 4)
+                name_bytes = f.read(nmlen)
+            fullpath = self.decode_name(name_bytes)
+            if self.debug:
+                print(f"[DEBUG] files={files}, fullpath={fullpath}")
+            if files == 0 or files > 10000:
+                print("Probably not a Coalesced file.")
+                return False
+            return True
         except Exception as e:
             print(f"Validation error: {e}")
             return False
 
-    def unpack(self, input_file, output_dir=None):
+    def unpack(self, input_file: str, output_dir: str | None = None) -> None:
         bin_name = os.path.splitext(os.path.basename(input_file))[0]
 
         # Always create a bin_name subfolder
@@ -84,73 +172,40 @@ class CoalescedTool:
         os.makedirs(output_dir, exist_ok=True)
 
         with open(input_file, "rb") as f:
-            self.files = self.read_int_be(f)
+            mv = memoryview(f.read())
+        pos = 0
 
-            for file_index in range(self.files):
-                self.nmlen = self.read_name_length_be(f)
-                if self.nmlen < 1:
-                    print(f"File name error at position {f.tell()}")
-                    return
+        read_int_be = self.read_int_be
+        read_name_length_be = self.read_name_length_be
 
-                self.fullpath = self.decode_name(f.read(self.nmlen))
-                f.seek(2, os.SEEK_CUR)  # skip null terminator
+        files, pos = read_int_be(mv, pos)
 
-                self.secCount = self.read_int_be(f)
+        for file_index in range(files):
+            nmlen, pos = read_name_length_be(mv, pos)
+            if nmlen < 1:
+                print(f"File name error at position {pos}")
+                return
 
-                if self.nmlen > 0:
-                    normalized_path = self.fullpath.replace("/", "\\")
+            fullpath = self.decode_name(bytes(mv[pos:pos + nmlen]))
+            pos += nmlen + 2  # skip null terminator
 
-                    # Strip all leading "../" or "..\"
-                    while normalized_path.startswith("..\\") or normalized_path.startswith("../"):
-                        parts = (
-                            normalized_path.split("\\", 1)
-                            if "\\" in normalized_path
-                            else normalized_path.split("/", 1)
-                        )
-                        normalized_path = parts[1] if len(parts) > 1 else ""
-
-                    clean_path = normalized_path.lstrip("\\/")
-                    full_output_path = os.path.join(output_dir, clean_path)
-                    os.makedirs(os.path.dirname(full_output_path), exist_ok=True)
-
-                    with open(full_output_path, "w", encoding="utf-8") as out_file:
-                        for sec_index in range(self.secCount):
-                            sec_name_len = self.read_name_length_be(f)
-                            sec_name_bytes = f.read(sec_name_len)
-                            section_name = sec_name_bytes.decode("utf-16le")
-                            f.seek(2, os.SEEK_CUR)  # skip null terminator
-
-                            out_file.write(f"[{section_name}]\n")
-
-                            self.recCount = self.read_int_be(f)
-
-                            for _ in range(self.recCount):
-                                key_name_len = self.read_name_length_be(f)
-                                key_name_bytes = f.read(key_name_len)
-                                key_name = key_name_bytes.decode("utf-16le")
-                                f.seek(2, os.SEEK_CUR)  # skip null terminator
-
-                                out_file.write(f"{key_name}=")
-
-                                self.valueLength = self.read_value_length_be(f)
-                                if self.valueLength > 0:
-                                    value_chars = []
-                                    for _ in range(self.valueLength):
-                                        char_bytes = f.read(2)
-                                        if char_bytes == b"\n\x00":
-                                            value_chars.append("\u00B6")  # ¶ symbol
-                                        else:
-                                            value_chars.append(char_bytes.decode("utf-16le"))
-                                    f.seek(2, os.SEEK_CUR)  # skip null terminator
-                                    value = "".join(value_chars).rstrip("\r\n")
-                                    out_file.write(value)
-
-                                out_file.write("\n")
-
-                            if sec_index != self.secCount - 1:
-                                out_file.write("\n")
-
-    def repack(self, input_dir, output_file=None):
+            sec_count, pos = read_int_be(mv, pos)
+
+            if nmlen > 0:
+                normalized_path = fullpath.replace("/", "\\")
+
+                # Strip all leading "../" or "..\"
+                clean_path = _DOTDOT_RE.sub("", normalized_path, count=1).lstrip("\\/")
+                full_output_path = os.path.join(output_dir, clean_path)
+                os.makedirs(os.path.dirname(full_output_path), exist_ok=True)
+
+                try:
+                    data, pos = _decode_sections(mv, pos, sec_count, self if self.debug else None)
+                except struct.error as e:
+                    raise EOFError("Unexpected EOF while reading int") from e
+                _write_ini(full_output_path, data)
+
+    def repack(self, input_dir: str, output_file: str | None = None) -> None:
         if not output_file:
             output_file = os.path.join(
                 os.path.dirname(input_dir),
@@ -158,28 +213,15 @@ class CoalescedTool:
             )
 
         # Gather extracted files
-        input_files = []
-        for root, _, files in os.walk(input_dir):
-            for file in files:
-                rel_path = os.path.relpath(os.path.join(root, file), input_dir)
-                input_files.append(rel_path)
-
-        self.files = len(input_files)
+        input_files = list(_iter_input_files(input_dir))
 
         with open(output_file, "wb") as out_f:
             # File count
-            out_f.write(struct.pack(">i", self.files))
-
-            for rel_path in input_files:
-                full_input_path = os.path.join(input_dir, rel_path)
-
-                # UE3 uses ..\..\ prefix
-                bin_path = "..\\..\\" + rel_path.replace("/", "\\")
+            out_f.write(_INT_BE.pack(len(input_files)))
 
-                # File name length
-                out_f.write(struct.pack(">i", -(len(bin_path) + 1)))
-                out_f.write(bin_path.encode("utf-16le"))
-                out_f.write(b"\x00\x00")
+            for full_input_path, bin_path_bytes, bin_path_len in input_files:
+                # Pieces of this entry; b"".join sizes the output once at the end
+                parts = [_INT_BE.pack(-(bin_path_len + 1)), bin_path_bytes, b"\x00\x00"]
 
                 # Parse ini file into sections and records
                 sections = []
@@ -187,46 +229,42 @@ class CoalescedTool:
                 current_records = []
 
                 with open(full_input_path, "r", encoding="utf-8") as ini_f:
-                    for line in ini_f:
-                        line = line.rstrip("\n").rstrip("\r")
-                        if line.startswith("[") and line.endswith("]"):
-                            if current_section is not None:
-                                sections.append((current_section, current_records))
-                                current_records = []
-                            current_section = line[1:-1]
-                        elif "=" in line:
-                            key, value = line.split("=", 1)
-                            value = value.replace("¶", "\n")
-                            current_records.append((key, value))
-                        elif not line.strip():
-                            continue
-
-                    if current_section is not None:
-                        sections.append((current_section, current_records))
+                    text = ini_f.read()
+
+                for match in _INI_LINE_RE.finditer(text):
+                    section_name, key, value = match.groups()
+                    if key is None:
+                        if current_section is not None:
+                            sections.append((current_section, current_records))
+                            current_records = []
+                        current_section = section_name
+                    else:
+                        value = value.replace("¶", "\n")
+                        current_records.append((key, value))
+
+                if current_section is not None:
+                    sections.append((current_section, current_records))
 
                 # Section count
-                out_f.write(struct.pack(">i", len(sections)))
+                parts.append(_INT_BE.pack(len(sections)))
 
                 for section_name, records in sections:
-                    # Section name length
-                    out_f.write(struct.pack(">i", -(len(section_name) + 1)))
-                    out_f.write(section_name.encode("utf-16le"))
-                    out_f.write(b"\x00\x00")
-
-                    # Record count
-                    out_f.write(struct.pack(">i", len(records)))
+                    # Section name length, name and record count
+                    sec = section_name.encode("utf-16le")
+                    parts += (_INT_BE.pack(-(len(sec) // 2 + 1)), sec, b"\x00\x00", _INT_BE.pack(len(records)))
 
                     for key, value in records:
-                        # Key name length
-                        out_f.write(struct.pack(">i", -(len(key) + 1)))
-                        out_f.write(key.encode("utf-16le"))
-                        out_f.write(b"\x00\x00")
-                        # Value length
-                        out_f.write(struct.pack(">i", -(len(value) + 1)))
-                        out_f.write(value.encode("utf-16le"))
-                        out_f.write(b"\x00\x00")
-
-def main():
+                        # Lengths count UTF-16 code units, plus the null terminator
+                        k = key.encode("utf-16le")
+                        v = value.encode("utf-16le")
+                        parts += (
+                            _INT_BE.pack(-(len(k) // 2 + 1)), k, b"\x00\x00",
+                            _INT_BE.pack(-(len(v) // 2 + 1)), v, b"\x00\x00",
+                        )
+
+                out_f.write(b"".join(parts))
+
+def main() -> None:
     if len(sys.argv) < 3:
         print("Usage:")
         print("  To unpack: py debaker.py unpack <input_file.bin> [output_dir] [--debug]")